@@ -0,0 +1,68 @@
+import asyncio
+import importlib
+import os
+from importlib.metadata import entry_points
+
+# Packages add sources by declaring an entry point in this group, e.g.
+# [project.entry-points."eternal_search.providers"]
+# github = "eternal_github:GithubServiceProvider"
+ENTRY_POINT_GROUP: str = 'eternal_search.providers'
+
+# Providers are referenced by import path so nothing is imported until a provider is first used.
+BUILTIN_PROVIDERS: dict = {
+    'slack': 'ServiceProviders:SlackServiceProvider',
+    'google': 'ServiceProviders:GoogleServiceProvider',
+    'atlassian': 'ServiceProviders:AtlassianServiceProvider',
+}
+
+WARMUP: bool = os.getenv('WARMUP', 'false').lower() == 'true'
+
+_provider_paths: dict = None
+_providers: dict = {}
+
+
+class AuthError(Exception):
+    """Raised when a provider rejects our credentials. Never negatively cached, re-authorizing fixes it."""
+
+
+def discover_entry_points() -> list:
+    discovered = entry_points()
+    if hasattr(discovered, 'select'):
+        return list(discovered.select(group=ENTRY_POINT_GROUP))
+    # Python 3.8 and 3.9 return a dict of groups and do not accept group=.
+    return discovered.get(ENTRY_POINT_GROUP, [])
+
+
+def provider_paths() -> dict:
+    global _provider_paths
+    if _provider_paths is None:
+        _provider_paths = dict(BUILTIN_PROVIDERS)
+        for entry_point in discover_entry_points():
+            _provider_paths[entry_point.name] = entry_point.value
+    return _provider_paths
+
+
+def provider_names() -> list:
+    return list(provider_paths())
+
+
+def get_provider(name: str):
+    if name not in _providers:
+        module_name, _, class_name = provider_paths()[name].partition(':')
+        _providers[name] = getattr(importlib.import_module(module_name), class_name)
+    return _providers[name]
+
+
+def get_providers() -> list:
+    return [get_provider(name) for name in provider_names()]
+
+
+async def warmup():
+    """Loads every provider, refreshes expired tokens and opens pooled connections, so the first search after a
+    deploy does not pay for imports, token refreshes and TLS handshakes."""
+    providers = get_providers()
+    results = await asyncio.gather(*(provider.warmup() for provider in providers), return_exceptions=True)
+    for provider, result in zip(providers, results):
+        if isinstance(result, Exception):
+            print(f'warmup of {provider.NAME} failed: {result}')
+    print(f'warmed up providers: {[provider.NAME for provider in providers]}')
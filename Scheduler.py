@@ -0,0 +1,191 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+import httpx
+
+# Priority classes, lower runs first.
+INTERACTIVE: int = 0
+REFRESH: int = 1
+CRAWL: int = 2
+PRIORITY_NAMES: dict = {INTERACTIVE: 'interactive', REFRESH: 'refresh', CRAWL: 'crawl'}
+
+# Outbound operations each class may have in flight. Background budgets shrink while the event loop lags.
+CONCURRENCY: dict = {
+    INTERACTIVE: int(os.getenv('INTERACTIVE_CONCURRENCY', '32')),
+    REFRESH: int(os.getenv('REFRESH_CONCURRENCY', '8')),
+    CRAWL: int(os.getenv('CRAWL_CONCURRENCY', '4')),
+}
+# Smoothed event loop lag above which a background class is no longer admitted, crawl backs off first.
+LAG_TARGET_SECONDS: dict = {
+    REFRESH: float(os.getenv('REFRESH_LAG_TARGET_SECONDS', '0.05')),
+    CRAWL: float(os.getenv('CRAWL_LAG_TARGET_SECONDS', '0.02')),
+}
+# Background work that cannot be admitted within this time is shed.
+MAX_WAIT_SECONDS: dict = {REFRESH: 10.0, CRAWL: 30.0}
+LAG_SAMPLE_SECONDS: float = 0.1
+
+current_priority: ContextVar = ContextVar('current_priority', default=INTERACTIVE)
+
+
+class Overloaded(Exception):
+    """Raised when background work is shed because it could not be admitted in time."""
+
+
+class Scheduler:
+    """Admission control for interactive searches and background work sharing one event loop.
+
+    Interactive work is only bounded by its own budget. Background classes are admitted while no higher class is
+    waiting and the event loop lag is under their target, and their budgets are halved on every lagging sample and
+    grow back by one otherwise.
+    """
+
+    def __init__(self):
+        self.limits = dict(CONCURRENCY)
+        self.in_flight = {priority: 0 for priority in CONCURRENCY}
+        self.waiting = {priority: 0 for priority in CONCURRENCY}
+        self.shed = {priority: 0 for priority in CONCURRENCY}
+        self.lag = 0.0
+        self.condition = None
+        self.tasks = set()
+
+    def get_condition(self) -> asyncio.Condition:
+        # Created on first use so that it binds to the running loop.
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    def start(self):
+        self.spawn(INTERACTIVE, self.monitor_lag())
+
+    async def monitor_lag(self):
+        loop = asyncio.get_running_loop()
+        condition = self.get_condition()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_SAMPLE_SECONDS)
+            lag = max(0.0, loop.time() - start - LAG_SAMPLE_SECONDS)
+            # Smoothed so that one slow tick does not stall all background work.
+            self.lag = 0.8 * self.lag + 0.2 * lag
+            for priority, target in LAG_TARGET_SECONDS.items():
+                if self.lag > target:
+                    self.limits[priority] = max(1, self.limits[priority] // 2)
+                else:
+                    self.limits[priority] = min(CONCURRENCY[priority], self.limits[priority] + 1)
+            async with condition:
+                condition.notify_all()
+
+    def admissible(self, priority: int) -> bool:
+        if self.in_flight[priority] >= self.limits[priority]:
+            return False
+        if priority == INTERACTIVE:
+            return True
+        if self.lag > LAG_TARGET_SECONDS[priority]:
+            return False
+        return not any(self.waiting[higher] for higher in self.waiting if higher < priority)
+
+    async def acquire(self, priority: int = None) -> int:
+        """Takes one unit of the class budget, the class defaults to the priority of the calling task."""
+        priority = current_priority.get() if priority is None else priority
+        condition = self.get_condition()
+        async with condition:
+            if not self.admissible(priority):
+                self.waiting[priority] += 1
+                try:
+                    admitted = condition.wait_for(lambda: self.admissible(priority))
+                    if priority == INTERACTIVE:
+                        await admitted
+                    else:
+                        await asyncio.wait_for(admitted, MAX_WAIT_SECONDS[priority])
+                except asyncio.TimeoutError:
+                    self.shed[priority] += 1
+                    raise Overloaded(f'{PRIORITY_NAMES[priority]} work shed after waiting '
+                                     f'{MAX_WAIT_SECONDS[priority]}s, event loop lag {self.lag:.3f}s')
+                finally:
+                    self.waiting[priority] -= 1
+                    condition.notify_all()
+            self.in_flight[priority] += 1
+        return priority
+
+    async def release(self, priority: int):
+        # Given back before taking the lock, so a release cancelled while waiting for it cannot leak the unit.
+        self.in_flight[priority] -= 1
+        condition = self.get_condition()
+        async with condition:
+            condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = None):
+        """Holds one unit of the class budget for the duration of the block."""
+        priority = await self.acquire(priority)
+        try:
+            yield
+        finally:
+            await self.release(priority)
+
+    def spawn(self, priority: int, coro) -> asyncio.Task:
+        task = asyncio.create_task(self.run(priority, coro))
+        # Keep a reference, the loop only holds weak references to tasks.
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def run(self, priority: int, coro):
+        # Runs inside its own task, so the priority only applies to this job and what it awaits.
+        current_priority.set(priority)
+        try:
+            return await coro
+        except Overloaded as e:
+            print(e)
+
+    def stats(self) -> dict:
+        return {
+            'event_loop_lag_seconds': round(self.lag, 4),
+            'classes': {
+                PRIORITY_NAMES[priority]: {
+                    'limit': self.limits[priority],
+                    'in_flight': self.in_flight[priority],
+                    'waiting': self.waiting[priority],
+                    'shed': self.shed[priority]
+                } for priority in CONCURRENCY
+            }
+        }
+
+
+scheduler = Scheduler()
+
+
+class SlotReleasingStream(httpx.AsyncByteStream):
+    """Response body that gives its scheduler slot back once closed, the body is read after the headers return."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, priority: int):
+        self.stream = stream
+        self.priority = priority
+        self.released = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                await scheduler.release(self.priority)
+
+
+class ScheduledTransport(httpx.AsyncHTTPTransport):
+    """Holds a slot of the calling task's priority class for every outbound request, until its response is closed."""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        priority = await scheduler.acquire()
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            await scheduler.release(priority)
+            raise
+        response.stream = SlotReleasingStream(response.stream, priority)
+        return response
@@ -0,0 +1,325 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+import redis
+from dotenv import load_dotenv
+
+from Scheduler import CRAWL, scheduler
+
+load_dotenv()
+store = redis.Redis()
+
+SEMANTIC_SEARCH: bool = os.getenv('SEMANTIC_SEARCH', 'false').lower() == 'true'
+SEMANTIC_INDEX_PATH: str = os.getenv('SEMANTIC_INDEX_PATH', 'semantic_index')
+# Small CPU sentence embedding model, set to 'hashing' to skip the model and use feature hashing.
+SEMANTIC_MODEL: str = os.getenv('SEMANTIC_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+HASHING_EMBEDDER: str = 'hashing'
+HASHING_DIMENSIONS: int = 512
+# Oldest documents are overwritten once the index holds this many.
+MAX_DOCUMENTS: int = int(os.getenv('SEMANTIC_MAX_DOCUMENTS', '100000'))
+
+INITIAL_CAPACITY: int = 1024
+# Below this many documents a full scan of the memory-mapped vectors is cheaper than probing IVF lists.
+IVF_MIN_DOCUMENTS: int = 4096
+IVF_LISTS: int = 64
+IVF_PROBES: int = 8
+TRAINING_SAMPLE: int = 16384
+# Cosine similarity below which a neighbour is not worth showing, hashing only matches shared spellings.
+MIN_SCORE: dict = {HASHING_EMBEDDER: 0.2}
+MODEL_MIN_SCORE: float = 0.35
+# Only what is needed to render a result is stored, not the full provider payload.
+STORED_FIELDS: tuple = ('source', 'title', 'link', 'id', 'username')
+SNIPPET_FIELDS: tuple = ('excerpt', 'text')
+SNIPPET_CHARS: int = 300
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+_model = None
+_model_loaded = False
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Loads the sentence embedding model once, None when it is unavailable and hashing is used instead."""
+    global _model, _model_loaded
+    with _model_lock:
+        if not _model_loaded:
+            _model_loaded = True
+            if SEMANTIC_MODEL != HASHING_EMBEDDER:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    _model = SentenceTransformer(SEMANTIC_MODEL, device='cpu')
+                except ImportError as e:
+                    print(f'sentence-transformers missing, install requirements-semantic.txt, falling back to '
+                          f'hashing: {e}')
+                except OSError as e:
+                    print(f'semantic model {SEMANTIC_MODEL} unavailable, falling back to hashing: {e}')
+    return _model
+
+
+def embedder_name() -> str:
+    return SEMANTIC_MODEL if get_model() is not None else HASHING_EMBEDDER
+
+
+def dimensions() -> int:
+    model = get_model()
+    return model.get_sentence_embedding_dimension() if model is not None else HASHING_DIMENSIONS
+
+
+def hash_embed(text: str) -> np.ndarray:
+    """Embeds text with signed feature hashing over words and character trigrams.
+
+    Only a fallback for when no model is available: it matches spelling variants like 'deploy' and 'deployment',
+    not synonyms. crc32 rather than hash() keeps it stable across processes.
+    """
+    vector = np.zeros(HASHING_DIMENSIONS, dtype=np.float32)
+    for word in TOKEN_PATTERN.findall(text.lower()):
+        padded = f'#{word}#'
+        features = [(word, 2.0)] + [(padded[i:i + 3], 1.0) for i in range(len(padded) - 2)]
+        for feature, weight in features:
+            digest = zlib.crc32(feature.encode("utf-8"))
+            vector[digest % HASHING_DIMENSIONS] += weight if digest & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+def embed_batch(texts: list) -> np.ndarray:
+    model = get_model()
+    if model is None:
+        return np.stack([hash_embed(text) for text in texts])
+    return model.encode(texts, batch_size=32, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def embed(text: str) -> np.ndarray:
+    return embed_batch([text])[0]
+
+
+def document_text(result: dict) -> str:
+    return ' '.join(str(result.get(field)) for field in ('title', 'excerpt', 'text') if result.get(field))
+
+
+def document_key(result: dict) -> str:
+    return str(result.get('link') or result.get('id') or document_text(result))
+
+
+def stored_document(key: str, result: dict) -> str:
+    document = {field: result.get(field) for field in STORED_FIELDS if result.get(field) is not None}
+    for field in SNIPPET_FIELDS:
+        if result.get(field):
+            document[field] = str(result.get(field))[:SNIPPET_CHARS]
+    document['key'] = key
+    return json.dumps(document)
+
+
+class SemanticIndex:
+    """Inverted-file (IVF) nearest neighbour index over memory-mapped vectors.
+
+    Vectors and their list assignments live in flat files under `path`, one directory per embedder; the documents
+    themselves are kept in redis next to the rest of the app state. Until IVF_MIN_DOCUMENTS are indexed every query
+    scans all vectors. Rows are reused round-robin once MAX_DOCUMENTS is reached, so the oldest documents go first.
+
+    add() and train() are CPU bound and block, run them in an executor, never on the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dimensions = None
+        self.min_score = None
+        self.docs_key = None
+        self.rows_key = None
+        self.next_key = None
+        self.trained_key = None
+        self.vectors = None
+        self.lists = None
+        self.centroids = None
+
+    def open(self):
+        if self.vectors is not None:
+            return
+        with self.lock:
+            if self.vectors is not None:
+                return
+            name = embedder_name()
+            slug = re.sub(r'\W+', '-', name)
+            self.dimensions = dimensions()
+            self.min_score = MIN_SCORE.get(name, MODEL_MIN_SCORE)
+            self.docs_key = f'SEMANTIC:{slug}:DOCS'
+            self.rows_key = f'SEMANTIC:{slug}:ROWS'
+            self.next_key = f'SEMANTIC:{slug}:NEXT'
+            self.trained_key = f'SEMANTIC:{slug}:TRAINED_AT'
+            self.vectors_path = os.path.join(self.path, slug, 'vectors.f32')
+            self.lists_path = os.path.join(self.path, slug, 'lists.i32')
+            self.centroids_path = os.path.join(self.path, slug, 'centroids.npy')
+            os.makedirs(os.path.join(self.path, slug), exist_ok=True)
+            if os.path.exists(self.centroids_path):
+                self.centroids = np.load(self.centroids_path)
+            self._map(min(MAX_DOCUMENTS, max(INITIAL_CAPACITY, self.count())))
+
+    def _map(self, capacity: int):
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.lists.flush()
+        for file_path, row_bytes in ((self.vectors_path, self.dimensions * 4), (self.lists_path, 4)):
+            if not os.path.exists(file_path) or os.path.getsize(file_path) < capacity * row_bytes:
+                with open(file_path, 'ab') as f:
+                    f.truncate(capacity * row_bytes)
+        capacity = os.path.getsize(self.vectors_path) // (self.dimensions * 4)
+        lists = np.memmap(self.lists_path, dtype=np.int32, mode='r+', shape=(capacity,))
+        # Assigned before vectors, which open() and search() check to see whether the index is mapped.
+        self.lists = lists
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dimensions))
+
+    def _nearest_list(self, vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        if centroids is None:
+            return np.full(len(vectors), -1, dtype=np.int32)
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+    def count(self) -> int:
+        if self.next_key is None:
+            return 0
+        return min(int(store.get(self.next_key) or 0), MAX_DOCUMENTS)
+
+    def size_bytes(self) -> int:
+        if self.vectors is None:
+            return 0
+        return self.vectors.nbytes + self.lists.nbytes + (self.centroids.nbytes if self.centroids is not None else 0)
+
+    def add(self, results: list) -> int:
+        self.open()
+        documents = {}
+        for result in results:
+            text = document_text(result)
+            if text:
+                documents.setdefault(document_key(result), (text, result))
+        if not documents:
+            return 0
+
+        with self.lock:
+            keys = list(documents)
+            existing_rows = store.hmget(self.rows_key, keys)
+            new_keys = [key for key, row in zip(keys, existing_rows) if row is None][-MAX_DOCUMENTS:]
+            if not new_keys:
+                return 0
+
+            vectors = embed_batch([documents[key][0] for key in new_keys])
+            total = store.incrby(self.next_key, len(new_keys))
+            first = total - len(new_keys)
+            rows = [(first + i) % MAX_DOCUMENTS for i in range(len(new_keys))]
+            needed = min(total, MAX_DOCUMENTS)
+            if self.vectors.shape[0] < needed:
+                self._map(min(max(self.vectors.shape[0] * 2, needed), MAX_DOCUMENTS))
+
+            pipe = store.pipeline()
+            if total > MAX_DOCUMENTS:
+                # Rows are being reused, forget the documents that lived in them.
+                evicted = [json.loads(document)['key'] for document in store.hmget(self.docs_key, rows)
+                           if document is not None]
+                if evicted:
+                    pipe.hdel(self.rows_key, *evicted)
+            self.vectors[rows] = vectors
+            self.lists[rows] = self._nearest_list(vectors, self.centroids)
+            pipe.hset(self.docs_key, mapping={row: stored_document(key, documents[key][1])
+                                              for row, key in zip(rows, new_keys)})
+            pipe.hset(self.rows_key, mapping=dict(zip(new_keys, rows)))
+            pipe.execute()
+            self.vectors.flush()
+            self.lists.flush()
+
+            trained_at = int(store.get(self.trained_key) or 0)
+            if needed >= IVF_MIN_DOCUMENTS and total >= 2 * trained_at:
+                self.train(needed, total)
+        return len(new_keys)
+
+    def train(self, count: int, total: int):
+        """Spherical k-means over a sample of the index, then reassigns every vector to its nearest list."""
+        rng = np.random.default_rng(0)
+        sample = self.vectors[np.sort(rng.choice(count, size=min(count, TRAINING_SAMPLE), replace=False))]
+        centroids = sample[rng.choice(len(sample), size=IVF_LISTS, replace=False)].copy()
+        for _ in range(10):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(IVF_LISTS):
+                members = sample[assignment == i]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[i] = centroid / (np.linalg.norm(centroid) or 1.0)
+
+        np.save(self.centroids_path, centroids)
+        for start in range(0, count, TRAINING_SAMPLE):
+            end = min(start + TRAINING_SAMPLE, count)
+            self.lists[start:end] = self._nearest_list(self.vectors[start:end], centroids)
+        self.lists.flush()
+        self.centroids = centroids
+        store.set(self.trained_key, total)
+        print(f'semantic index trained {IVF_LISTS} lists over {count} documents')
+
+    def search(self, search_term: str, k: int = 5) -> list:
+        self.open()
+        # Taken once, add() may remap or retrain from another thread while this runs.
+        vectors, lists, centroids = self.vectors, self.lists, self.centroids
+        count = min(self.count(), vectors.shape[0])
+        if count == 0:
+            return []
+        query = embed(search_term)
+        if centroids is None:
+            candidates = np.arange(count)
+        else:
+            probes = np.argsort(centroids @ query)[-IVF_PROBES:]
+            candidates = np.flatnonzero(np.isin(lists[:count], probes))
+        scores = vectors[candidates] @ query
+        best = np.argsort(scores)[::-1][:k]
+        best = best[scores[best] >= self.min_score]
+        if len(best) == 0:
+            return []
+
+        documents = store.hmget(self.docs_key, [int(row) for row in candidates[best]])
+        search_results = []
+        for document, score in zip(documents, scores[best]):
+            if document is not None:
+                result = json.loads(document)
+                result.pop('key', None)
+                result['semantic_score'] = round(float(score), 3)
+                search_results.append(result)
+        return search_results
+
+
+semantic_index = SemanticIndex(SEMANTIC_INDEX_PATH)
+
+
+async def preload():
+    """Loads (on a fresh host downloads) the model and maps the index, so no interactive search waits for it."""
+    await asyncio.get_running_loop().run_in_executor(None, semantic_index.open)
+    print(f'semantic index ready, embedding with {embedder_name()}')
+
+
+async def index_results(search_results: list):
+    async with scheduler.slot(CRAWL):
+        await asyncio.get_running_loop().run_in_executor(None, semantic_index.add, search_results)
+
+
+async def blend_semantic_results(search_term: str, keyword_results: list, k: int = 5) -> list:
+    """Appends semantic neighbours that the providers did not return, and queues the keyword hits for indexing."""
+    start = time.perf_counter()
+    # Embedding the query is CPU bound, it runs in an executor so other searches keep going.
+    semantic_results = await asyncio.get_running_loop().run_in_executor(None, semantic_index.search, search_term, k)
+
+    seen = {document_key(result) for result in keyword_results}
+    blended_results = list(keyword_results)
+    for result in semantic_results:
+        if document_key(result) not in seen:
+            blended_results.append(result)
+
+    latency_ms = (time.perf_counter() - start) * 1000
+    # Indexing is background work, the keyword hits are in this response already.
+    scheduler.spawn(CRAWL, index_results(keyword_results))
+    print(f'semantic search: {len(blended_results) - len(keyword_results)} extra results, '
+          f'index {semantic_index.count()} documents / {semantic_index.size_bytes()} bytes, {latency_ms:.2f} ms')
+    return blended_results
@@ -1,12 +1,15 @@
 import httpx
 import os
 import redis
+from functools import lru_cache, wraps
 from dotenv import load_dotenv
 from datetime import datetime, timezone
-from httpx_oauth.oauth2 import OAuth2
+from httpx_oauth.oauth2 import OAuth2, RefreshTokenError
 from oauthlib.common import UNICODE_ASCII_CHARACTER_SET
 from random import SystemRandom
 from cryptography.fernet import Fernet
+from ProviderRegistry import AuthError
+from Scheduler import ScheduledTransport
 
 load_dotenv()
 store = redis.Redis()
@@ -15,9 +18,77 @@ store = redis.Redis()
 HOST_URL = os.getenv('HOST_URL')
 
 KEY = os.getenv('KEY')
-cipher = Fernet(KEY.encode("utf-8"))
 
 timeout = httpx.Timeout(10.0)
+# Connections opened by warmup should still be in the pool when the first search arrives.
+limits = httpx.Limits(max_keepalive_connections=20, keepalive_expiry=120.0)
+
+USAGE_BUCKET_SECONDS: int = 60
+USAGE_RETENTION_SECONDS: int = 24 * 60 * 60
+# Fraction of the per-minute quota after which searches degrade to fewer sub-searches and smaller pages.
+QUOTA_DEGRADE_THRESHOLD: float = float(os.getenv('QUOTA_DEGRADE_THRESHOLD', '0.8'))
+PAGE_SIZE: int = 5
+# Only saves units where the quota counts results or bytes. Atlassian and Slack count calls, so near the quota they
+# drop calls instead.
+DEGRADED_PAGE_SIZE: int = 2
+# How long a sub-search that found nothing, or failed upstream, is answered from the negative cache.
+NEGATIVE_CACHE_EMPTY_TTL: int = int(os.getenv('NEGATIVE_CACHE_EMPTY_TTL', '120'))
+NEGATIVE_CACHE_ERROR_TTL: int = int(os.getenv('NEGATIVE_CACHE_ERROR_TTL', '15'))
+
+
+@lru_cache(maxsize=None)
+def get_cipher() -> Fernet:
+    return Fernet(KEY.encode("utf-8"))
+
+
+_client: httpx.AsyncClient = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Shared client so every provider call reuses pooled connections instead of a new TLS handshake."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=timeout, transport=ScheduledTransport(limits=limits))
+    return _client
+
+
+def canonical_query(search_term: str) -> str:
+    return ' '.join(search_term.lower().split())
+
+
+def negative_cached(endpoint: str):
+    """Answers a sub-search from the negative cache, and caches empty results and upstream errors (ValueError).
+
+    Repeated typos and failing queries then cost a redis lookup instead of upstream round-trips. Auth failures
+    propagate uncached.
+    """
+    def decorator(search):
+        @wraps(search)
+        async def wrapper(cls, search_term: str, access_token: str, **kwargs) -> list:
+            key = f"NEGATIVE:{cls.NAME}:{endpoint}:{canonical_query(search_term)}"
+            cached = store.get(key)
+            if cached is not None:
+                print(f'{endpoint} negative cache hit ({cached.decode("utf-8")}) for {search_term}')
+                return []
+
+            try:
+                search_results = await search(cls, search_term=search_term, access_token=access_token, **kwargs)
+            except ValueError as e:
+                print(f'{endpoint} search failed: {e}')
+                store.set(key, 'error', ex=NEGATIVE_CACHE_ERROR_TTL)
+                return []
+
+            if not search_results:
+                store.set(key, 'empty', ex=NEGATIVE_CACHE_EMPTY_TTL)
+            return search_results
+        return wrapper
+    return decorator
+
+
+def usage_bucket(timestamp: float = None) -> int:
+    if timestamp is None:
+        timestamp = datetime.now(tz=timezone.utc).timestamp()
+    return int(timestamp) // USAGE_BUCKET_SECONDS * USAGE_BUCKET_SECONDS
 
 
 class BaseServiceProvider:
@@ -30,23 +101,122 @@ class BaseServiceProvider:
     AUTH_URL: str
     TOKEN_URL: str
     REFRESH_URL: str
-    oauth: OAuth2
+    # Quota units the provider allows per USAGE_BUCKET_SECONDS, 0 means untracked. Tokens are stored per app, so
+    # every Slack user searches as the same provider account and the budget is shared by all of them.
+    QUOTA_UNITS_PER_MINUTE: int = 0
+    # Endpoints that draw on QUOTA_UNITS_PER_MINUTE, None means all of them.
+    QUOTA_ENDPOINTS: tuple = None
+    # Quota units charged per endpoint call, endpoints not listed cost 1 unit.
+    QUOTA_UNITS: dict = {}
+    # Extra parameters sent with the authorization url, e.g. to request offline access.
+    AUTHORIZATION_PARAMS: dict = {}
+    # API endpoints whose connections warmup opens ahead of the first search.
+    WARMUP_URLS: list = []
 
     @classmethod
     async def search(cls, search_term: str, access_token: str, **kwargs) -> list:
         raise NotImplementedError
 
+    @classmethod
+    def search_kwargs(cls) -> dict:
+        return {}
+
+    @classmethod
+    def get_oauth(cls) -> OAuth2:
+        # Built on first use so that importing the providers does not construct every OAuth2 client.
+        if '_oauth' not in cls.__dict__:
+            cls._oauth = OAuth2(
+                name=cls.NAME,
+                client_id=cls.CLIENT_ID,
+                client_secret=cls.CLIENT_SECRET,
+                authorize_endpoint=cls.AUTH_URL,
+                access_token_endpoint=cls.TOKEN_URL,
+                refresh_token_endpoint=cls.REFRESH_URL,
+                base_scopes=cls.SCOPES)
+        return cls._oauth
+
+    @classmethod
+    async def complete_authorization(cls, code: str):
+        oauth2_token = await cls.get_initial_oauth_token(code=code)
+        cls.persist_oauth_token(oauth2_token=oauth2_token)
+
+    @classmethod
+    async def warmup(cls):
+        """Refreshes an expired access token and opens pooled connections to the provider's API hosts."""
+        await cls.get_access_token()
+        client = get_client()
+        for url in cls.WARMUP_URLS:
+            try:
+                await client.head(url)
+            except httpx.HTTPError as e:
+                print(f'warmup of {url} failed: {e}')
+
+    @classmethod
+    def record_usage(cls, endpoint: str, response: httpx.Response, user_id: str = None):
+        bucket = usage_bucket()
+        key = f"USAGE:{cls.NAME}:{bucket}"
+        units = cls.QUOTA_UNITS.get(endpoint, 1)
+        size = len(response.content)
+
+        pipe = store.pipeline()
+        for scope in ('total', f'endpoint:{endpoint}', f'user:{user_id or "default"}'):
+            pipe.hincrby(key, f'{scope}:calls', 1)
+            pipe.hincrby(key, f'{scope}:bytes', size)
+            pipe.hincrby(key, f'{scope}:units', units)
+        if cls.QUOTA_ENDPOINTS is None or endpoint in cls.QUOTA_ENDPOINTS:
+            pipe.hincrby(key, 'quota:units', units)
+        pipe.expire(key, USAGE_RETENTION_SECONDS)
+        pipe.execute()
+
+    @classmethod
+    def get_usage(cls, bucket: int) -> dict:
+        usage = store.hgetall(f"USAGE:{cls.NAME}:{bucket}")
+        return {field.decode("utf-8"): int(value) for field, value in usage.items()}
+
+    @classmethod
+    def burn_rate(cls) -> float:
+        """Quota units spent over the last minute, weighting the previous bucket by how much of it is still in the
+        window so the rate does not drop to zero at every bucket boundary."""
+        now = datetime.now(tz=timezone.utc).timestamp()
+        bucket = usage_bucket(now)
+        elapsed = (now - bucket) / USAGE_BUCKET_SECONDS
+        current_units = cls.get_usage(bucket).get('quota:units', 0)
+        previous_units = cls.get_usage(bucket - USAGE_BUCKET_SECONDS).get('quota:units', 0)
+        return current_units + previous_units * (1 - elapsed)
+
+    @classmethod
+    def near_quota(cls) -> bool:
+        if not cls.QUOTA_UNITS_PER_MINUTE:
+            return False
+        return cls.burn_rate() >= cls.QUOTA_UNITS_PER_MINUTE * QUOTA_DEGRADE_THRESHOLD
+
+    @classmethod
+    def page_size(cls) -> int:
+        return DEGRADED_PAGE_SIZE if cls.near_quota() else PAGE_SIZE
+
+    @classmethod
+    def usage_stats(cls) -> dict:
+        burn_rate = cls.burn_rate()
+        return {
+            'quota_units_per_minute': cls.QUOTA_UNITS_PER_MINUTE,
+            'quota_endpoints': list(cls.QUOTA_ENDPOINTS) if cls.QUOTA_ENDPOINTS is not None else 'all',
+            'burn_rate_units_per_minute': round(burn_rate, 2),
+            'quota_used': round(burn_rate / cls.QUOTA_UNITS_PER_MINUTE, 3) if cls.QUOTA_UNITS_PER_MINUTE else None,
+            'degraded': cls.near_quota(),
+            'current_bucket': cls.get_usage(usage_bucket())
+        }
+
     @classmethod
     async def get_access_token(cls):
         print(cls)
         print(cls.NAME)
         if store.hget(cls.NAME, 'ACCESS'):
-            access_token = cipher.decrypt((store.hget(cls.NAME, 'ACCESS'))).decode("utf-8")
+            access_token = get_cipher().decrypt((store.hget(cls.NAME, 'ACCESS'))).decode("utf-8")
             expiry_time = int(store.hget(cls.NAME, 'EXPIRES_AT').decode("utf-8"))
             if expiry_time < int(round(datetime.now(tz=timezone.utc).timestamp())):
                 await cls.refresh_token()
 
-                access_token = cipher.decrypt((store.hget(cls.NAME, 'ACCESS'))).decode("utf-8")
+                access_token = get_cipher().decrypt((store.hget(cls.NAME, 'ACCESS'))).decode("utf-8")
             return access_token
         return None
 
@@ -60,9 +230,9 @@ class BaseServiceProvider:
         expires_at = oauth2_token.get('expires_in') + int(round(datetime.now(tz=timezone.utc).timestamp()))
         scopes = oauth2_token.get('scope')
 
-        store.hset(cls.NAME, "ACCESS", cipher.encrypt(access_token.encode("utf-8")))
+        store.hset(cls.NAME, "ACCESS", get_cipher().encrypt(access_token.encode("utf-8")))
         if refresh_token is not None:
-            store.hset(cls.NAME, "REFRESH", cipher.encrypt(refresh_token.encode("utf-8")))
+            store.hset(cls.NAME, "REFRESH", get_cipher().encrypt(refresh_token.encode("utf-8")))
         store.hset(cls.NAME, "EXPIRES_AT", str(expires_at))
         store.hset(cls.NAME, "SCOPES", scopes)
 
@@ -71,23 +241,40 @@ class BaseServiceProvider:
 
         print(cls)
         print(cls.NAME)
-        refresh_token = cipher.decrypt((store.hget(cls.NAME, 'REFRESH'))).decode("utf-8")
+        encrypted_refresh_token = store.hget(cls.NAME, 'REFRESH')
+        if encrypted_refresh_token is None:
+            raise AuthError(f'{cls.NAME} has no refresh token stored')
+        refresh_token = get_cipher().decrypt(encrypted_refresh_token).decode("utf-8")
         print("refreshing access token")
-        oauth2_token = await cls.oauth.refresh_token(refresh_token=refresh_token)
+        try:
+            oauth2_token = await cls.get_oauth().refresh_token(refresh_token=refresh_token)
+        except RefreshTokenError as e:
+            # Newer httpx-oauth releases also wrap transport failures and server errors in RefreshTokenError. Only a
+            # rejected refresh token needs re-authorizing, anything else is negatively cached as a short lived error.
+            response = getattr(e, 'response', None)
+            if isinstance(e.__cause__, httpx.TransportError) or (response is not None and
+                                                                  response.status_code not in (400, 401)):
+                raise ValueError(f'{cls.NAME} token refresh failed: {e}')
+            raise AuthError(f'{cls.NAME} refresh token rejected: {e}')
+        except httpx.HTTPError as e:
+            raise ValueError(f'{cls.NAME} token refresh failed: {e}')
+        if not oauth2_token.get('access_token'):
+            raise ValueError(f'{cls.NAME} token refresh returned no access token')
         cls.persist_oauth_token(oauth2_token)
+        return oauth2_token.get('access_token')
 
     @classmethod
-    async def get_authorization_url(cls, extras_params: dict):
+    async def get_authorization_url(cls, extras_params: dict = None):
 
-        return await cls.oauth.get_authorization_url(
+        return await cls.get_oauth().get_authorization_url(
             redirect_uri=cls.REDIRECT_URL,
             state=cls.generate_token(),
-            extras_params=extras_params)
+            extras_params=cls.AUTHORIZATION_PARAMS if extras_params is None else extras_params)
 
     @classmethod
     async def get_initial_oauth_token(cls, code):
 
-        oauth2_token = await cls.oauth.get_access_token(code=code, redirect_uri=cls.REDIRECT_URL)
+        oauth2_token = await cls.get_oauth().get_access_token(code=code, redirect_uri=cls.REDIRECT_URL)
         return oauth2_token
 
     @classmethod
@@ -115,18 +302,26 @@ class GoogleServiceProvider(BaseServiceProvider):
     REFRESH_URL: str = 'https://www.googleapis.com/oauth2/v4/token'
     GDRIVE_API_URL: str = 'https://www.googleapis.com/drive/v3/files'
     GMAIL_API_URL: str = 'https://gmail.googleapis.com/gmail/v1/users/me/messages'
+    RATE_LIMIT_REASONS: tuple = ('rateLimitExceeded', 'userRateLimitExceeded', 'dailyLimitExceeded')
+    # Gmail allows 250 units per second for the one authorized Google account. Drive has a separate per-project
+    # query quota, far above what searches spend, so Drive calls are recorded but do not draw on this budget.
+    QUOTA_UNITS_PER_MINUTE: int = int(os.getenv('GOOGLE_QUOTA_UNITS_PER_MINUTE', '15000'))
+    QUOTA_ENDPOINTS: tuple = ('gmail.messages.list', 'gmail.messages.get')
+    QUOTA_UNITS: dict = {'gmail.messages.list': 5, 'gmail.messages.get': 5, 'drive.files.list': 1}
+    AUTHORIZATION_PARAMS: dict = {'prompt': 'consent', 'access_type': 'offline'}
+    WARMUP_URLS: list = [GDRIVE_API_URL, GMAIL_API_URL]
 
-    oauth: OAuth2 = OAuth2(
-        name=NAME,
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        authorize_endpoint=AUTH_URL,
-        access_token_endpoint=TOKEN_URL,
-        refresh_token_endpoint=REFRESH_URL,
-        base_scopes=SCOPES)
+    @classmethod
+    def is_rate_limited(cls, response: httpx.Response) -> bool:
+        # Google answers 403 both for missing scopes and for rate limits, only the error reason tells them apart.
+        try:
+            errors = response.json()['error']['errors']
+        except (ValueError, KeyError, TypeError):
+            return False
+        return any(error.get('reason') in cls.RATE_LIMIT_REASONS for error in errors)
 
     @classmethod
-    async def get_mail(cls, message_id: str, access_token: str):
+    async def get_mail(cls, message_id: str, access_token: str, user_id: str = None):
 
         params = {
             'format': 'minimal'
@@ -135,114 +330,131 @@ class GoogleServiceProvider(BaseServiceProvider):
                    'Accept': 'application/json'}
 
         retry = True
+        refreshed = False
 
         try:
-            async with httpx.AsyncClient() as client:
-                while retry:
-                    response: httpx.Response = await client.get(url=f"{cls.GMAIL_API_URL}/{message_id}",
-                                                                headers=headers,
-                                                                timeout=timeout, params=params)
-                    if response.status_code == 200:
-                        retry = False
-                    elif response.status_code == 401:
-                        await cls.refresh_token()
-                    else:
-                        raise ValueError("Invalid Response")
+            client = get_client()
+            while retry:
+                response: httpx.Response = await client.get(url=f"{cls.GMAIL_API_URL}/{message_id}",
+                                                            headers=headers,
+                                                            timeout=timeout, params=params)
+                cls.record_usage('gmail.messages.get', response, user_id)
+                if response.status_code == 200:
+                    retry = False
+                elif response.status_code == 401 and not refreshed:
+                    headers['Authorization'] = f"Bearer {await cls.refresh_token()}"
+                    refreshed = True
+                elif response.status_code in (401, 403) and not cls.is_rate_limited(response):
+                    raise AuthError(f'{cls.NAME} rejected the access token with {response.status_code}')
+                else:
+                    raise ValueError("Invalid Response")
             return response.json()['snippet']
         except ValueError:
             print(str(ValueError))
             return ""
 
     @classmethod
+    @negative_cached('gmail.messages.list')
     async def gmail_search(cls, search_term: str, access_token: str, **kwargs) -> list:
+        page_size = cls.page_size()
         gmail_params = {
-            'q': f'{search_term}'
+            'q': f'{search_term}',
+            'maxResults': page_size
         }
 
         headers = {'Authorization': f"Bearer {access_token}",
                    'Accept': 'application/json'}
 
         retry = True
-
-        try:
-
-            async with httpx.AsyncClient() as client:
-
-                while retry:
-                    response: httpx.Response = await client.get(url=cls.GMAIL_API_URL, params=gmail_params,
-                                                                headers=headers,
-                                                                timeout=timeout)
-                    if response.status_code == 200:
-                        retry = False
-                    elif response.status_code == 401:
-                        await cls.refresh_token()
-                    else:
-                        raise ValueError("Invalid Response")
-
-            print("GMail response is: " + str(response.json()))
-            gmail_response_list = response.json()['messages'][:5]
-            search_results = []
-            for result in gmail_response_list:
-                mail_result = await cls.get_mail(message_id=result.get('id'), access_token=access_token)
-                search_results.append({
-                    'title': mail_result,
-                    'id': result.get('id')
-                })
-            return search_results
-        except ValueError:
-            print(str(ValueError))
-            return []
+        refreshed = False
+
+        client = get_client()
+        while retry:
+            response: httpx.Response = await client.get(url=cls.GMAIL_API_URL, params=gmail_params,
+                                                        headers=headers,
+                                                        timeout=timeout)
+            cls.record_usage('gmail.messages.list', response, kwargs.get('user_id'))
+            if response.status_code == 200:
+                retry = False
+            elif response.status_code == 401 and not refreshed:
+                headers['Authorization'] = f"Bearer {await cls.refresh_token()}"
+                refreshed = True
+            elif response.status_code in (401, 403) and not cls.is_rate_limited(response):
+                raise AuthError(f'{cls.NAME} rejected the access token with {response.status_code}')
+            else:
+                raise ValueError("Invalid Response")
+
+        print("GMail response is: " + str(response.json()))
+        # Gmail leaves out 'messages' entirely when nothing matches.
+        gmail_response_list = response.json().get('messages', [])[:page_size]
+        search_results = []
+        for result in gmail_response_list:
+            mail_result = await cls.get_mail(message_id=result.get('id'), access_token=access_token,
+                                             user_id=kwargs.get('user_id'))
+            search_results.append({
+                'source': 'Gmail',
+                'title': mail_result,
+                'id': result.get('id')
+            })
+        return search_results
 
     @classmethod
+    @negative_cached('drive.files.list')
     async def gdrive_search(cls, search_term: str, access_token: str, **kwargs) -> list:
         # corpora should be not sent if the user does not belong to any enterprise domain.
+        page_size = cls.page_size()
         gdrive_params = {
             'q': f'fullText contains "{search_term}"',
             'corpora': 'user',
-            'fields': 'files(name, webViewLink, id)'
+            'fields': 'files(name, webViewLink, id)',
+            'pageSize': page_size
         }
         headers = {'Authorization': f"Bearer {access_token}",
                    'Accept': 'application/json'}
 
         retry = True
-
-        try:
-
-            async with httpx.AsyncClient() as client:
-
-                while retry:
-                    response: httpx.Response = await client.get(url=cls.GDRIVE_API_URL, params=gdrive_params,
-                                                                headers=headers,
-                                                                timeout=timeout)
-                    if response.status_code == 200:
-                        retry = False
-                    elif response.status_code == 400:
-                        gdrive_params = {
-                            'q': f'fullText contains "{search_term}"'
-                        }
-                    elif response.status_code == 401:
-                        await cls.refresh_token()
-                    else:
-                        raise ValueError("Invalid Response")
-
-            print("GDrive response is: " + str(response.json()))
-            gdrive_response_list = response.json()['files']
-            search_results = []
-            for result in gdrive_response_list:
-                search_results.append({
-                    'title': result.get('name'),
-                    'link': result.get('webViewLink'),
-                    'id': result.get('id')
-                })
-            return search_results[:5]
-        except ValueError:
-            print(str(ValueError))
-            return []
+        refreshed = False
+
+        client = get_client()
+        while retry:
+            response: httpx.Response = await client.get(url=cls.GDRIVE_API_URL, params=gdrive_params,
+                                                        headers=headers,
+                                                        timeout=timeout)
+            cls.record_usage('drive.files.list', response, kwargs.get('user_id'))
+            if response.status_code == 200:
+                retry = False
+            elif response.status_code == 400:
+                gdrive_params = {
+                    'q': f'fullText contains "{search_term}"',
+                    'pageSize': page_size
+                }
+            elif response.status_code == 401 and not refreshed:
+                headers['Authorization'] = f"Bearer {await cls.refresh_token()}"
+                refreshed = True
+            elif response.status_code in (401, 403) and not cls.is_rate_limited(response):
+                raise AuthError(f'{cls.NAME} rejected the access token with {response.status_code}')
+            else:
+                raise ValueError("Invalid Response")
+
+        print("GDrive response is: " + str(response.json()))
+        gdrive_response_list = response.json()['files']
+        search_results = []
+        for result in gdrive_response_list:
+            search_results.append({
+                'source': 'Drive',
+                'title': result.get('name'),
+                'link': result.get('webViewLink'),
+                'id': result.get('id')
+            })
+        return search_results[:page_size]
 
     @classmethod
     async def search(cls, search_term: str, access_token: str, **kwargs) -> list:
         google_results: list = []
-        gmail_results: list = await cls.gmail_search(search_term=search_term, access_token=access_token, **kwargs)
+        gmail_results: list = []
+        # A gmail search costs one list call plus one get per message, so it is dropped first near the quota.
+        if not cls.near_quota():
+            gmail_results = await cls.gmail_search(search_term=search_term, access_token=access_token, **kwargs)
         gdrive_results: list = await cls.gdrive_search(search_term=search_term, access_token=access_token, **kwargs)
         google_results.extend(gmail_results)
         google_results.extend(gdrive_results)
@@ -263,123 +475,147 @@ class AtlassianServiceProvider(BaseServiceProvider):
     REFRESH_URL: str = 'https://auth.atlassian.com/oauth/token'
     CONFLUENCE_API_URL: str = 'https://api.atlassian.com/ex/confluence'
     JIRA_API_URL: str = 'https://api.atlassian.com/ex/jira'
+    QUOTA_UNITS_PER_MINUTE: int = int(os.getenv('ATLASSIAN_QUOTA_UNITS_PER_MINUTE', '600'))
+    ACCESSIBLE_RESOURCES_URL: str = 'https://api.atlassian.com/oauth/token/accessible-resources'
+    AUTHORIZATION_PARAMS: dict = {'prompt': 'consent', 'audience': 'api.atlassian.com'}
+    WARMUP_URLS: list = [JIRA_API_URL]
+
+    @classmethod
+    def search_kwargs(cls) -> dict:
+        return {'cloud_id': store.hget("ATLASSIAN", "CLOUD_ID").decode("utf-8")}
 
-    oauth: OAuth2 = OAuth2(
-        name=NAME,
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        authorize_endpoint=AUTH_URL,
-        access_token_endpoint=TOKEN_URL,
-        refresh_token_endpoint=REFRESH_URL,
-        base_scopes=SCOPES)
+    @classmethod
+    async def complete_authorization(cls, code: str):
+        oauth2_token = await cls.get_initial_oauth_token(code=code)
+
+        atlassian_access_token = oauth2_token.get('access_token')
+
+        response: httpx.Response = await get_client().get(url=cls.ACCESSIBLE_RESOURCES_URL,
+                                                          headers={'Authorization': f"Bearer {atlassian_access_token}",
+                                                                   'Accept': 'application/json'})
+        atlassian_cloud_id = response.json()[0]['id']
+        atlassian_cloud_url = response.json()[0]['url']
+
+        cls.persist_oauth_token(oauth2_token=oauth2_token)
+        store.hset("ATLASSIAN", "CLOUD_ID", str(atlassian_cloud_id))
+        store.hset("ATLASSIAN", "CLOUD_URL", str(atlassian_cloud_url))
 
     @classmethod
+    @negative_cached('jira.search')
     async def jira_search(cls, search_term: str, access_token: str, **kwargs):
         query = f'text~"{search_term}"'
+        page_size = cls.page_size()
         headers = {'Authorization': f"Bearer {access_token}",
                    'Accept': 'application/json'}
 
         retry = True
-
-        try:
-            async with httpx.AsyncClient() as client:
-
-                while retry:
-                    response: httpx.Response = await client.get(
-                        url=f"{cls.JIRA_API_URL}/{kwargs.get('cloud_id')}/rest/api/3/search",
-                        params={
-                            'jql': query
-                        },
-                        headers=headers,
-                        timeout=timeout)
-
-                    # Confirm if status code for expired access token is correct.
-                    if response.status_code == 200:
-                        retry = False
-                    elif response.status_code == 403:
-                        await cls.refresh_token()
-                    else:
-                        raise ValueError("Invalid Response")
-
-            jira_results: list = response.json()['issues']
-            print("Jira response is: " + str(jira_results))
-            search_results = []
-            for result in jira_results:
-
-                link = store.hget("ATLASSIAN", "CLOUD_URL").decode("utf-8") + "/browse/" + result['key']
-                title = result['key'] + " " + result['fields']['summary']
-                print(link)
-                search_results.append({
-                    'title': title,
-                    'link': link,
-                    'id': result['id']
-                })
-                print(result)
-            return search_results
-
-        except ValueError:
-            print(str(ValueError))
-            return []
+        refreshed = False
+
+        client = get_client()
+        while retry:
+            response: httpx.Response = await client.get(
+                url=f"{cls.JIRA_API_URL}/{kwargs.get('cloud_id')}/rest/api/3/search",
+                params={
+                    'jql': query,
+                    'maxResults': page_size
+                },
+                headers=headers,
+                timeout=timeout)
+            cls.record_usage('jira.search', response, kwargs.get('user_id'))
+
+            # Atlassian answers an expired access token with 401 and a token lacking a scope with 403.
+            if response.status_code == 200:
+                retry = False
+            elif response.status_code in (401, 403) and not refreshed:
+                headers['Authorization'] = f"Bearer {await cls.refresh_token()}"
+                refreshed = True
+            elif response.status_code in (401, 403):
+                raise AuthError(f'{cls.NAME} rejected the access token with {response.status_code}')
+            else:
+                raise ValueError("Invalid Response")
+
+        jira_results: list = response.json()['issues']
+        print("Jira response is: " + str(jira_results))
+        search_results = []
+        for result in jira_results:
+
+            link = store.hget("ATLASSIAN", "CLOUD_URL").decode("utf-8") + "/browse/" + result['key']
+            title = result['key'] + " " + result['fields']['summary']
+            print(link)
+            search_results.append({
+                'source': 'Jira',
+                'title': title,
+                'link': link,
+                'id': result['id']
+            })
+            print(result)
+        return search_results
 
     @classmethod
+    @negative_cached('confluence.search')
     async def confluence_search(cls, search_term: str, access_token: str, **kwargs) -> list:
         query = f'text~"{search_term}"'
+        page_size = cls.page_size()
         headers = {'Authorization': f"Bearer {access_token}",
                    'Accept': 'application/json'}
 
         retry = True
-
-        try:
-            async with httpx.AsyncClient() as client:
-
-                while retry:
-                    response: httpx.Response = await client.get(
-                        url=f"{cls.CONFLUENCE_API_URL}/{kwargs.get('cloud_id')}/wiki/rest/api/search",
-                        params={
-                            'cql': query
-                        },
-                        headers=headers,
-                        timeout=timeout)
-
-                    # Confirm if status code for expired access token is correct.
-                    if response.status_code == 200:
-                        retry = False
-                    elif response.status_code == 403:
-                        await cls.refresh_token()
-                    else:
-                        raise ValueError("Invalid Response")
-
-            confluence_results: list = response.json()['results']
-            print("confluence response is: " + str(confluence_results))
-            search_results = []
-            for result in confluence_results:
-                link = store.hget("ATLASSIAN", "CLOUD_URL").decode("utf-8") + result['content']['_links'].get('webui')
-                title = result['content']['title']
-                excerpt = result['excerpt'].replace("@@@hl@@@", "")
-                excerpt = excerpt.replace("@@@endhl@@@", "")
-                print(link)
-                search_results.append({
-                    'excerpt': excerpt,
-                    'title': title,
-                    'link': link,
-                    'id': result['content']['id'],
-                    'score': result.get('score', 0)
-                })
-                print(result)
-            return search_results
-
-        except ValueError:
-            print(str(ValueError))
-            return []
+        refreshed = False
+
+        client = get_client()
+        while retry:
+            response: httpx.Response = await client.get(
+                url=f"{cls.CONFLUENCE_API_URL}/{kwargs.get('cloud_id')}/wiki/rest/api/search",
+                params={
+                    'cql': query,
+                    'limit': page_size
+                },
+                headers=headers,
+                timeout=timeout)
+            cls.record_usage('confluence.search', response, kwargs.get('user_id'))
+
+            # Atlassian answers an expired access token with 401 and a token lacking a scope with 403.
+            if response.status_code == 200:
+                retry = False
+            elif response.status_code in (401, 403) and not refreshed:
+                headers['Authorization'] = f"Bearer {await cls.refresh_token()}"
+                refreshed = True
+            elif response.status_code in (401, 403):
+                raise AuthError(f'{cls.NAME} rejected the access token with {response.status_code}')
+            else:
+                raise ValueError("Invalid Response")
+
+        confluence_results: list = response.json()['results']
+        print("confluence response is: " + str(confluence_results))
+        search_results = []
+        for result in confluence_results:
+            link = store.hget("ATLASSIAN", "CLOUD_URL").decode("utf-8") + result['content']['_links'].get('webui')
+            title = result['content']['title']
+            excerpt = result['excerpt'].replace("@@@hl@@@", "")
+            excerpt = excerpt.replace("@@@endhl@@@", "")
+            print(link)
+            search_results.append({
+                'source': 'Confluence',
+                'excerpt': excerpt,
+                'title': title,
+                'link': link,
+                'id': result['content']['id'],
+                'score': result.get('score', 0)
+            })
+            print(result)
+        return search_results
 
     @classmethod
     async def search(cls, search_term: str, access_token: str, **kwargs) -> list:
         atlassian_results: list = []
-        jira_results: list = await cls.jira_search(search_term=search_term, access_token=access_token, **kwargs)
+        jira_results: list = []
+        # Atlassian rate limits by calls, not results, so near the quota the jira sub-search is dropped.
+        if not cls.near_quota():
+            jira_results = await cls.jira_search(search_term=search_term, access_token=access_token, **kwargs)
         confluence_results: list = await cls.confluence_search(search_term=search_term,
                                                                access_token=access_token, **kwargs)
-        atlassian_results.extend(confluence_results[:5])
-        atlassian_results.extend(jira_results[:5])
+        atlassian_results.extend(confluence_results[:PAGE_SIZE])
+        atlassian_results.extend(jira_results[:PAGE_SIZE])
         return atlassian_results
 
 
@@ -395,55 +631,72 @@ class SlackServiceProvider(BaseServiceProvider):
     TOKEN_URL: str = 'https://slack.com/api/oauth.v2.access'
     REFRESH_URL: str = 'https://slack.com/api/oauth.v2.access'
     SLACK_API_URL: str = 'https://slack.com/api/search.all'
-    oauth: OAuth2 = OAuth2(
-        name=NAME,
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        authorize_endpoint=AUTH_URL,
-        access_token_endpoint=TOKEN_URL,
-        refresh_token_endpoint=REFRESH_URL,
-        base_scopes=SCOPES)
+    AUTH_ERRORS: tuple = ('invalid_auth', 'not_authed', 'account_inactive', 'token_revoked', 'token_expired',
+                          'missing_scope')
+    # search.all is a Tier 2 method, roughly 20 calls per minute.
+    QUOTA_UNITS_PER_MINUTE: int = int(os.getenv('SLACK_QUOTA_UNITS_PER_MINUTE', '20'))
+    AUTHORIZATION_PARAMS: dict = {'user_scope': USER_SCOPES}
+    WARMUP_URLS: list = [SLACK_API_URL]
+
+    @classmethod
+    async def complete_authorization(cls, code: str):
+        oauth2_token = await cls.get_initial_oauth_token(code=code)
+        oauth2_token = cls.fix_access_token(oauth2_token)
+        cls.persist_oauth_token(oauth2_token=oauth2_token)
 
     @classmethod
     async def search(cls, search_term: str, access_token: str, **kwargs) -> list:
+        # search.all is the only call, and Tier 2 limits calls, so near the quota slack is skipped until the rate drops.
+        # Checked outside the negative cache so that a skipped search is not cached as having found nothing.
+        if cls.near_quota():
+            print(f'{cls.NAME} near its quota, skipping search')
+            return []
+        return await cls.search_all(search_term=search_term, access_token=access_token, **kwargs)
+
+    @classmethod
+    @negative_cached('search.all')
+    async def search_all(cls, search_term: str, access_token: str, **kwargs) -> list:
+        page_size = cls.page_size()
         headers = {'Authorization': f"Bearer {access_token}",
                    'Accept': 'application/json'}
 
         retry = True
-
-        try:
-            async with httpx.AsyncClient() as client:
-
-                while retry:
-                    response: httpx.Response = await client.get(url=f"{cls.SLACK_API_URL}",
-                                                                params={'query': search_term, 'highlight': False},
-                                                                headers=headers,
-                                                                timeout=timeout)
-                    print("slack response is: " + str(response.json()))
-                    response_json = response.json()
-                    if response_json['ok'] is True:
-                        retry = False
-                    elif response_json['ok'] is False and response_json['error'] == "invalid_auth":
-                        await cls.refresh_token()
-                    else:
-                        raise ValueError("Invalid Response")
-
-            slack_results: list = response.json()['messages']['matches']
-            search_results = []
-            for result in slack_results:
-                if 'coade search' not in result.get('username'):
-                    search_results.append({
-                        'username': result.get('username'),
-                        'text': result.get('text'),
-                        'link': result.get('permalink'),
-                        'id': result.get('iid'),
-                        'score': result.get('score')
-                    })
-            return search_results[:5]
-
-        except ValueError:
-            print(str(ValueError))
-            return []
+        refreshed = False
+
+        client = get_client()
+        while retry:
+            # Ask for twice the page size to leave room for our own bot messages filtered out below.
+            response: httpx.Response = await client.get(url=f"{cls.SLACK_API_URL}",
+                                                        params={'query': search_term, 'highlight': False,
+                                                                'count': page_size * 2},
+                                                        headers=headers,
+                                                        timeout=timeout)
+            cls.record_usage('search.all', response, kwargs.get('user_id'))
+            print("slack response is: " + str(response.json()))
+            response_json = response.json()
+            if response_json['ok'] is True:
+                retry = False
+            elif response_json['ok'] is False and response_json['error'] == "invalid_auth" and not refreshed:
+                headers['Authorization'] = f"Bearer {await cls.refresh_token()}"
+                refreshed = True
+            elif response_json['ok'] is False and response_json['error'] in cls.AUTH_ERRORS:
+                raise AuthError(response_json['error'])
+            else:
+                raise ValueError("Invalid Response")
+
+        slack_results: list = response.json()['messages']['matches']
+        search_results = []
+        for result in slack_results:
+            if 'coade search' not in result.get('username'):
+                search_results.append({
+                    'source': 'Slack',
+                    'username': result.get('username'),
+                    'text': result.get('text'),
+                    'link': result.get('permalink'),
+                    'id': result.get('iid'),
+                    'score': result.get('score')
+                })
+        return search_results[:page_size]
 
     @staticmethod
     def fix_access_token(params: dict) -> dict:
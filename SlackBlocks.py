@@ -0,0 +1,126 @@
+import uuid
+
+import orjson
+import redis
+
+store = redis.Redis()
+
+# Results shown per provider in the first message, the rest are served by the "More from" buttons.
+TOP_N: int = 3
+MORE_PAGE_SIZE: int = 5
+# Result sets are kept so that "More from" can page through them without searching again.
+RESULTS_TTL_SECONDS: int = 60 * 60
+# Slack allows 50 blocks per message and 3000 characters per section.
+MAX_BLOCKS: int = 50
+MAX_SECTION_CHARS: int = 3000
+SNIPPET_CHARS: int = 280
+# Budget for the serialized payload, estimated while building so it is only serialized once.
+MAX_PAYLOAD_BYTES: int = 16000
+BLOCK_OVERHEAD_BYTES: int = 120
+MORE_ACTION_ID: str = 'more_results'
+
+
+def escape(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def truncate(text: str, length: int) -> str:
+    return text if len(text) <= length else text[:length - 1] + '…'
+
+
+def group_by_source(search_results: list) -> dict:
+    grouped_results = {}
+    for result in search_results:
+        grouped_results.setdefault(result.get('source', 'Other'), []).append(result)
+    return grouped_results
+
+
+def store_results(search_results: list) -> str:
+    search_id = uuid.uuid4().hex
+    store.set(f"RESULTS:{search_id}", orjson.dumps(group_by_source(search_results)), ex=RESULTS_TTL_SECONDS)
+    return search_id
+
+
+def load_results(search_id: str, source: str) -> list:
+    grouped_results = store.get(f"RESULTS:{search_id}")
+    if grouped_results is None:
+        return []
+    return orjson.loads(grouped_results).get(source, [])
+
+
+def result_block(result: dict) -> dict:
+    title = escape(truncate(str(result.get('title') or result.get('username') or 'Untitled'), SNIPPET_CHARS))
+    lines = [f"*<{result.get('link')}|{title}>*" if result.get('link') else f"*{title}*"]
+    if result.get('username') is not None and result.get('title') is not None:
+        lines.append(f"From: *{escape(result.get('username'))}*")
+    snippet = result.get('excerpt') or result.get('text')
+    if snippet:
+        lines.append(escape(truncate(str(snippet), SNIPPET_CHARS)))
+    return {'type': 'section', 'text': {'type': 'mrkdwn', 'text': truncate('\n'.join(lines), MAX_SECTION_CHARS)}}
+
+
+def more_button(search_id: str, source: str, offset: int) -> dict:
+    return {
+        'type': 'button',
+        'text': {'type': 'plain_text', 'text': truncate(f'More from {source}', 75)},
+        'action_id': f'{MORE_ACTION_ID}:{source}',
+        'value': f'{search_id}:{source}:{offset}'
+    }
+
+
+def block_size(block: dict) -> int:
+    text = block.get('text', {}).get('text', '')
+    return len(text.encode("utf-8")) + BLOCK_OVERHEAD_BYTES * max(1, len(block.get('elements', [])))
+
+
+def prepare_blocks(search_term: str, search_results: list, search_id: str, suggestions: list = None) -> list:
+    """Renders the top results of every provider in its own section, with a "More from" button when it has more.
+
+    Providers that no longer fit in the block or size budget are left with just their button.
+    """
+    blocks = [{'type': 'section',
+               'text': {'type': 'mrkdwn',
+                        'text': f"Results for *{escape(truncate(search_term, SNIPPET_CHARS))}*"
+                        if search_results else f"No results for *{escape(truncate(search_term, SNIPPET_CHARS))}*"}}]
+    if suggestions:
+        blocks.append({'type': 'context',
+                       'elements': [{'type': 'mrkdwn',
+                                     'text': 'Try: ' + ', '.join(f'`{escape(term)}`' for term in suggestions)}]})
+    size = sum(block_size(block) for block in blocks)
+    overflow_buttons = []
+
+    for source, source_results in group_by_source(search_results).items():
+        source_blocks = [{'type': 'header', 'text': {'type': 'plain_text', 'text': source}}]
+        source_blocks.extend(result_block(result) for result in source_results[:TOP_N])
+        if len(source_results) > TOP_N:
+            source_blocks.append({'type': 'actions', 'elements': [more_button(search_id, source, TOP_N)]})
+        source_size = sum(block_size(block) for block in source_blocks)
+
+        # One block is kept in reserve for the overflow buttons.
+        if len(blocks) + len(source_blocks) < MAX_BLOCKS and size + source_size <= MAX_PAYLOAD_BYTES:
+            blocks.extend(source_blocks)
+            size += source_size
+        else:
+            overflow_buttons.append(more_button(search_id, source, 0))
+
+    if overflow_buttons:
+        # An actions block holds at most 25 elements.
+        blocks.append({'type': 'actions', 'elements': overflow_buttons[:25]})
+    return blocks
+
+
+def prepare_more_blocks(search_id: str, source: str, offset: int) -> list:
+    source_results = load_results(search_id=search_id, source=source)
+    if not source_results:
+        return [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': 'These results have expired, search again.'}}]
+
+    page = source_results[offset:offset + MORE_PAGE_SIZE]
+    blocks = [{'type': 'header', 'text': {'type': 'plain_text', 'text': f'More from {source}'}}]
+    blocks.extend(result_block(result) for result in page)
+    if offset + MORE_PAGE_SIZE < len(source_results):
+        blocks.append({'type': 'actions', 'elements': [more_button(search_id, source, offset + MORE_PAGE_SIZE)]})
+    return blocks
+
+
+def serialize_message(text: str, blocks: list) -> bytes:
+    return orjson.dumps({'response_type': 'in_channel', 'text': text, 'blocks': blocks})
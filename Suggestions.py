@@ -0,0 +1,192 @@
+import asyncio
+import os
+
+import redis
+
+from Scheduler import CRAWL, Overloaded, scheduler
+
+store = redis.Redis()
+
+SUGGESTIONS_KEY: str = 'SUGGESTIONS'
+SNAPSHOT_SECONDS: int = int(os.getenv('SUGGESTIONS_SNAPSHOT_SECONDS', '60'))
+# Suggestions kept at every trie node, so a lookup is a walk down the prefix and nothing else.
+TOP_K: int = 8
+MAX_TERM_CHARS: int = 60
+# Terms kept in memory and in redis. Past the cap the least used are evicted, down to PRUNE_RATIO of it so that
+# pruning stays occasional.
+MAX_TERMS: int = int(os.getenv('SUGGESTIONS_MAX_TERMS', '20000'))
+PRUNE_RATIO: float = 0.9
+# A query somebody typed is a better completion than a title that merely showed up in results.
+QUERY_WEIGHT: int = 3
+TITLE_WEIGHT: int = 1
+# Only titles people gave their documents. Gmail results carry the message snippet, which is private mail content.
+TITLE_SOURCES: tuple = ('Drive', 'Confluence', 'Jira')
+
+
+class TrieNode:
+    __slots__ = ('children', 'top', 'terms')
+
+    def __init__(self):
+        # Most nodes are leaves, their dict is only created once they get a child.
+        self.children = None
+        self.top = []
+        # Terms passing through this node, it is deleted once the last of them is evicted.
+        self.terms = 0
+
+
+class SuggestionTrie:
+    """Prefix trie over past queries and result titles, with the TOP_K most popular completions cached per node."""
+
+    def __init__(self):
+        self.root = TrieNode()
+        self.counts = {}
+        # Increments not yet written to redis and evicted terms not yet deleted from it, flushed by snapshot().
+        self.pending = {}
+        self.evicted = set()
+
+    def add(self, term: str, weight: int = 1, persist: bool = True):
+        term = ' '.join(term.lower().split())[:MAX_TERM_CHARS]
+        if not term:
+            return
+        is_new = term not in self.counts
+        count = self.counts.get(term, 0) + weight
+        self.counts[term] = count
+        if persist:
+            self.pending[term] = self.pending.get(term, 0) + weight
+
+        node = self.root
+        path = [node]
+        for char in term:
+            if node.children is None:
+                node.children = {}
+            node = node.children.setdefault(char, TrieNode())
+            path.append(node)
+        for node in path:
+            if is_new:
+                node.terms += 1
+            self.update_top(node, term, count)
+
+        if len(self.counts) > MAX_TERMS:
+            self.prune()
+
+    def prune(self):
+        evict = sorted(self.counts, key=self.counts.get)[:len(self.counts) - int(MAX_TERMS * PRUNE_RATIO)]
+        short = {}
+        for term in evict:
+            self.remove(term, short)
+        # Deepest first, so every node is rebuilt from children whose tops are complete again.
+        for prefix in sorted(short, key=len, reverse=True):
+            self.refill(short[prefix], prefix)
+        self.evicted.update(evict)
+        print(f'evicted {len(evict)} suggestions')
+
+    def remove(self, term: str, short: dict):
+        """Strips a term from the trie, collecting the nodes whose top lost an entry it has to get back in short."""
+        del self.counts[term]
+        self.pending.pop(term, None)
+        path = [('', None, self.root)]
+        for index, char in enumerate(term):
+            node = path[-1][2]
+            child = node.children.get(char) if node.children else None
+            if child is None:
+                break
+            path.append((term[:index + 1], node, child))
+        for prefix, parent, node in reversed(path):
+            node.terms -= 1
+            node.top = [entry for entry in node.top if entry[1] != term]
+            if parent is not None and node.terms <= 0:
+                del parent.children[prefix[-1]]
+                if not parent.children:
+                    parent.children = None
+            elif len(node.top) < min(TOP_K, node.terms):
+                # Tied terms left out of the top still pass through this node.
+                short[prefix] = node
+
+    def refill(self, node: TrieNode, prefix: str):
+        # The top of a node is within the tops of its children plus the term ending at the node itself.
+        candidates = [entry for child in (node.children or {}).values() for entry in child.top]
+        if prefix in self.counts:
+            candidates.append((self.counts[prefix], prefix))
+        candidates.sort(key=lambda entry: (-entry[0], entry[1]))
+        node.top = candidates[:TOP_K]
+
+    @staticmethod
+    def update_top(node: TrieNode, term: str, count: int):
+        if len(node.top) == TOP_K and term not in (entry[1] for entry in node.top) and count <= node.top[-1][0]:
+            return
+        node.top = [entry for entry in node.top if entry[1] != term]
+        node.top.append((count, term))
+        node.top.sort(key=lambda entry: (-entry[0], entry[1]))
+        del node.top[TOP_K:]
+
+    def suggest(self, prefix: str, limit: int = TOP_K) -> list:
+        node = self.root
+        for char in ' '.join(prefix.lower().split()):
+            node = node.children.get(char) if node.children else None
+            if node is None:
+                return []
+        return [term for _, term in node.top[:limit]]
+
+    def load(self):
+        stored = sorted(((int(count), term) for term, count in store.hgetall(SUGGESTIONS_KEY).items()), reverse=True)
+        for count, term in stored[:MAX_TERMS]:
+            self.add(term.decode("utf-8"), weight=count, persist=False)
+        # Also trims what was evicted while redis was unreachable, or by other app processes.
+        if len(stored) > MAX_TERMS:
+            store.hdel(SUGGESTIONS_KEY, *(term for _, term in stored[MAX_TERMS:]))
+        print(f'loaded {len(self.counts)} suggestions')
+
+    async def snapshot(self):
+        if not self.pending and not self.evicted:
+            return
+        pending, self.pending = self.pending, {}
+        evicted, self.evicted = self.evicted, set()
+        try:
+            # Only the redis round-trip runs in a worker thread, the trie is only ever touched on the event loop.
+            await asyncio.get_running_loop().run_in_executor(None, self.write, pending, evicted)
+        except redis.RedisError:
+            # Evicted terms are left to the trim in load(), keeping them would grow without bound during an outage.
+            self.restore(pending=pending)
+            raise
+
+    @staticmethod
+    def write(pending: dict, evicted: set):
+        pipe = store.pipeline()
+        # Deleted first, so that a term evicted and searched again since restarts from its new count.
+        if evicted:
+            pipe.hdel(SUGGESTIONS_KEY, *evicted)
+        # Increments rather than overwrites, so several app processes can share one suggestion set.
+        for term, weight in pending.items():
+            pipe.hincrby(SUGGESTIONS_KEY, term, weight)
+        pipe.execute()
+
+    def restore(self, pending: dict):
+        for term, weight in pending.items():
+            # Terms evicted in the meantime stay evicted.
+            if term in self.counts:
+                self.pending[term] = self.pending.get(term, 0) + weight
+
+    async def snapshot_forever(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_SECONDS)
+            try:
+                async with scheduler.slot(CRAWL):
+                    await self.snapshot()
+            except Overloaded as e:
+                # Pending increments are kept for the next snapshot.
+                print(f'suggestions snapshot skipped: {e}')
+            except redis.RedisError as e:
+                # Pending increments are restored and retried with the next snapshot.
+                print(f'suggestions snapshot failed: {e}')
+
+
+suggestion_trie = SuggestionTrie()
+
+
+def record_search(search_term: str, search_results: list):
+    # Queries that found nothing are usually typos, suggesting them would only spread the typo.
+    if search_results:
+        suggestion_trie.add(search_term, weight=QUERY_WEIGHT)
+    for result in search_results:
+        if result.get('source') in TITLE_SOURCES and result.get('title'):
+            suggestion_trie.add(str(result.get('title')), weight=TITLE_WEIGHT)
@@ -2,16 +2,19 @@ import asyncio
 import uvloop
 import uvicorn
 import httpx
-import redis
-from fastapi import FastAPI, Request
+import orjson
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import HTMLResponse, RedirectResponse
 from starlette.datastructures import ImmutableMultiDict
-from ServiceProviders import AtlassianServiceProvider, GoogleServiceProvider, SlackServiceProvider
+from ProviderRegistry import WARMUP, AuthError, get_provider, get_providers, provider_names, warmup
+from SemanticIndex import SEMANTIC_SEARCH, blend_semantic_results, preload
+from SlackBlocks import prepare_blocks, prepare_more_blocks, serialize_message, store_results
+from Suggestions import record_search, suggestion_trie
+from Scheduler import CRAWL, INTERACTIVE, REFRESH, scheduler
 
 app = FastAPI()
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 httpxClient = httpx.AsyncClient()
-store = redis.Redis()
 
 
 # currently, this app is user agnostic. we will have to make it in such a way that user sign into or platform,
@@ -25,7 +28,22 @@ store = redis.Redis()
 # Todo: Add unit tests. p1
 # Todo: Return formatted and relevant search results. p0
 # Todo: figure out how to add the app to slack. p0
-# Todo: handle gmail no response error. p0
+
+
+@app.on_event('startup')
+async def startup():
+    scheduler.start()
+    suggestion_trie.load()
+    scheduler.spawn(CRAWL, suggestion_trie.snapshot_forever())
+    if WARMUP:
+        await scheduler.spawn(REFRESH, warmup())
+    if SEMANTIC_SEARCH:
+        await scheduler.spawn(REFRESH, preload())
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    await suggestion_trie.snapshot()
 
 
 @app.get('/')
@@ -38,65 +56,61 @@ def home():
     :read"><img alt="Add to Slack" height="40" width="139" src="https://platform.slack-edge.com/img/add_to_slack.png" 
     srcSet="https://platform.slack-edge.com/img/add_to_slack.png 1x, 
     https://platform.slack-edge.com/img/add_to_slack@2x.png 2x" /></a> <form action="search" method="POST"> <input 
-    type="text" placeholder="Search.." name="text"> <button type="submit">Search</button> </form> """
+    type="text" placeholder="Search.." name="text" list="suggestions" autocomplete="off" 
+    oninput="fetch('suggest?q=' + encodeURIComponent(this.value)).then(r => r.json()).then(d => 
+    document.getElementById('suggestions').replaceChildren(...d.suggestions.map(s => new Option(s))))"> <datalist 
+    id="suggestions"></datalist> <button type="submit">Search</button> </form> """
     return HTMLResponse(content=html_content, status_code=200)
 
 
+# The built-in providers keep the urls registered with their OAuth apps, and are resolved per request so that they
+# are only imported once used.
 @app.get('/authorize-atlassian')
 async def authorize_atlassian():
-    authorization_url = await AtlassianServiceProvider.get_authorization_url(
-        extras_params={'prompt': 'consent',
-                       'audience': 'api.atlassian.com'})
-    return RedirectResponse(authorization_url)
+    return await authorize_provider(name='atlassian')
 
 
 @app.get('/authorize-google')
 async def authorize_google():
-    authorization_url = await GoogleServiceProvider.get_authorization_url(
-        extras_params={'prompt': 'consent',
-                       'access_type': 'offline'})
-    return RedirectResponse(authorization_url)
+    return await authorize_provider(name='google')
 
 
 @app.get('/authorize-slack')
 async def authorize_slack():
-    authorization_url = await SlackServiceProvider.get_authorization_url(
-        extras_params={
-            'user_scope': SlackServiceProvider.USER_SCOPES})
-    return RedirectResponse(authorization_url)
+    return await authorize_provider(name='slack')
 
 
-@app.get(f'/{GoogleServiceProvider.REDIRECT_URI}')
+@app.get('/gdrive-authorization-success')
 async def google_authorization_success(code: str):
-    oauth2_token = await GoogleServiceProvider.get_initial_oauth_token(code=code)
-    GoogleServiceProvider.persist_oauth_token(oauth2_token=oauth2_token)
-    return RedirectResponse('/home')
+    return await provider_authorization_success(name='google', code=code)
 
 
-@app.get(f'/{SlackServiceProvider.REDIRECT_URI}')
+@app.get('/slack-authorization-success')
 async def slack_authorization_success(code: str):
-    oauth2_token = await SlackServiceProvider.get_initial_oauth_token(code=code)
-    oauth2_token = SlackServiceProvider.fix_access_token(oauth2_token)
-    SlackServiceProvider.persist_oauth_token(oauth2_token=oauth2_token)
-    return RedirectResponse('/home')
+    return await provider_authorization_success(name='slack', code=code)
 
 
-@app.get(f'/{AtlassianServiceProvider.REDIRECT_URI}')
+@app.get('/atlassian-authorization-success')
 async def atlassian_authorization_success(code: str):
-    oauth2_token = await AtlassianServiceProvider.get_initial_oauth_token(code=code)
+    return await provider_authorization_success(name='atlassian', code=code)
 
-    atlassian_access_token = oauth2_token.get('access_token')
 
-    response: httpx.Response = await httpxClient.get(url='https://api.atlassian.com/oauth/token/accessible-resources',
-                                                     headers={'Authorization': f"Bearer {atlassian_access_token}",
-                                                              'Accept': 'application/json'})
-    atlassian_cloud_id = response.json()[0]['id']
-    atlassian_cloud_url = response.json()[0]['url']
+def get_provider_or_404(name: str):
+    if name not in provider_names():
+        raise HTTPException(status_code=404, detail=f'Unknown provider {name}')
+    return get_provider(name)
+
+
+# Providers discovered through entry points use these routes, their REDIRECT_URI is 'authorization-success/<name>'.
+@app.get('/authorize/{name}')
+async def authorize_provider(name: str):
+    authorization_url = await get_provider_or_404(name).get_authorization_url()
+    return RedirectResponse(authorization_url)
 
-    AtlassianServiceProvider.persist_oauth_token(oauth2_token=oauth2_token)
-    store.hset("ATLASSIAN", "CLOUD_ID", str(atlassian_cloud_id))
-    store.hset("ATLASSIAN", "CLOUD_URL", str(atlassian_cloud_url))
 
+@app.get('/authorization-success/{name}')
+async def provider_authorization_success(name: str, code: str):
+    await get_provider_or_404(name).complete_authorization(code=code)
     return RedirectResponse('/home')
 
 
@@ -106,11 +120,12 @@ async def search(request: Request):
     text = request_form.get("text")
 
     response_url = request_form.get('response_url')
+    user_id = request_form.get('user_id')
 
     print(f'text = {text}')
     print(f'response_url = {response_url}')
 
-    asyncio.create_task(search_worker(text=text, response_url=response_url))
+    scheduler.spawn(INTERACTIVE, search_worker(text=text, response_url=response_url, user_id=user_id))
 
     response = {
         "response_type": "in_channel",
@@ -120,61 +135,79 @@ async def search(request: Request):
     return response
 
 
-async def search_worker(text: str, response_url: str):
-    print('inside search worker')
-
-    complete_search_result = []
+@app.get('/suggest')
+async def suggest(q: str, limit: int = 8):
+    # Served from memory only, no provider or redis round-trip.
+    return {"suggestions": suggestion_trie.suggest(prefix=q, limit=limit)}
 
-    slack_access_token = await SlackServiceProvider.get_access_token()
-    if slack_access_token:
-        slack_search_results = await SlackServiceProvider.search(search_term=text, access_token=slack_access_token)
-        complete_search_result.extend(slack_search_results)
 
-    google_access_token = await GoogleServiceProvider.get_access_token()
-    if google_access_token:
+@app.get('/stats')
+async def stats():
+    return {provider.NAME: provider.usage_stats() for provider in get_providers()}
 
-        gdrive_search_results = await GoogleServiceProvider.search(search_term=text, access_token=google_access_token)
-        complete_search_result.extend(gdrive_search_results)
 
-    atlassian_access_token = await AtlassianServiceProvider.get_access_token()
-    if atlassian_access_token:
+@app.get('/stats/scheduler')
+async def scheduler_stats():
+    return scheduler.stats()
 
-        confluence_search_results = await AtlassianServiceProvider.search(search_term=text,
-                                                                          access_token=atlassian_access_token,
-                                                                          cloud_id=store.hget("ATLASSIAN", "CLOUD_ID")
-                                                                          .decode("utf-8"))
-        complete_search_result.extend(confluence_search_results)
 
-    prepared_response = prepare_response(complete_search_result)
-    print(f'Complete search results: {prepared_response}')
+async def search_worker(text: str, response_url: str, user_id: str = None):
+    print('inside search worker')
 
-    response = await httpxClient.post(url=response_url, json={"text": prepared_response,
-                                                              "response_type": "in_channel",
-                                                              "type": "mrkdwn"}
-                                      )
+    complete_search_result = []
 
-    print(f'post response status {response.status_code} and content {response.content}')
+    for provider in get_providers():
+        try:
+            access_token = await provider.get_access_token()
+            if access_token:
+                complete_search_result.extend(await provider.search(search_term=text, access_token=access_token,
+                                                                    user_id=user_id, **provider.search_kwargs()))
+        except AuthError as e:
+            # Expired or revoked credentials only cost this provider's results, not the whole search.
+            print(f'{provider.NAME} needs to be authorized again: {e}')
+        except ValueError as e:
+            # A token refresh that failed upstream, the provider is tried again with the next search.
+            print(f'{provider.NAME} search failed: {e}')
+
+    if SEMANTIC_SEARCH:
+        complete_search_result = await blend_semantic_results(search_term=text,
+                                                              keyword_results=complete_search_result)
+
+    suggestions = [] if complete_search_result else suggestion_trie.suggest(prefix=text[:3], limit=5)
+    record_search(search_term=text, search_results=complete_search_result)
+
+    search_id = store_results(complete_search_result)
+    blocks = prepare_blocks(search_term=text, search_results=complete_search_result, search_id=search_id,
+                            suggestions=suggestions)
+    await post_blocks(response_url=response_url, text=f"Search results for {text}", blocks=blocks)
 
     return
 
 
-def prepare_response(search_results: list):
-    prepared_response = ""
-    for result in search_results:
-        if result.get('title') is not None:
-            prepared_response = prepared_response + f"Title: *{result.get('title')}* \n"
-        if result.get('username') is not None:
-            prepared_response = prepared_response + f"From: *{result.get('username')}* \n"
-        if result.get('text') is not None:
-            prepared_response = prepared_response + f"{result.get('text')} \n"
-        if result.get('excerpt') is not None:
-            prepared_response = prepared_response + f"{result.get('excerpt')} \n"
-        if result.get('link') is not None:
-            prepared_response = prepared_response + f"link: {result.get('link')}"
+@app.post('/interactivity')
+async def interactivity(request: Request):
+    request_form: ImmutableMultiDict = await request.form()
+    payload = orjson.loads(request_form.get('payload'))
+
+    for action in payload.get('actions', []):
+        search_id, source_offset = action.get('value').split(':', 1)
+        source, offset = source_offset.rsplit(':', 1)
+        blocks = prepare_more_blocks(search_id=search_id, source=source, offset=int(offset))
+        scheduler.spawn(INTERACTIVE, post_blocks(response_url=payload.get('response_url'), text=f"More from {source}",
+                                                 blocks=blocks))
+
+    return {}
 
-        prepared_response = prepared_response + "\n\n\n"
 
-    return prepared_response
+async def post_blocks(response_url: str, text: str, blocks: list):
+    # Serialized once and sent as is, instead of letting httpx encode the json again.
+    content = serialize_message(text=text, blocks=blocks)
+    print(f'posting {len(blocks)} blocks, {len(content)} bytes')
+
+    response = await httpxClient.post(url=response_url, content=content,
+                                      headers={'Content-Type': 'application/json'})
+
+    print(f'post response status {response.status_code} and content {response.content}')
 
 
 if __name__ == '__main__':